@@ -3,20 +3,44 @@ from discord.ext import commands
 from discord.ui import View, Button, Modal, TextInput
 from discord import ButtonStyle, Interaction
 from discord import PermissionOverwrite
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import (
+    BulkWriteError, ConnectionFailure, ExecutionTimeout, OperationFailure, PyMongoError
+)
+import pymongo
 import random
 import string
 import os
+import socket
+import threading
+import time
 from datetime import datetime, timedelta, UTC
 import asyncio
+import bisect
+import functools
+import hashlib
+import math
+import json
+import sqlite3
+import weakref
 
 # MongoDB connection setup
-client = MongoClient(os.getenv("MONGODB_URI"))
+# Short timeouts so a stalled or slow cluster fails fast and trips the circuit breaker
+client = MongoClient(
+    os.getenv("MONGODB_URI"),
+    serverSelectionTimeoutMS=2000,
+    connectTimeoutMS=2000,
+    timeoutMS=3000  # Limit for any single operation, including a hung primary
+)
+MONGODB_LONG_TIMEOUT = 600  # Seconds allowed for full scans such as cache loads and backfills
+MONGODB_INTERACTION_TIMEOUT = 2.5  # Seconds shared by every call in one interaction, inside Discord's 3s reply window
 db = client["cashback_bot"]
 users_collection = db["users"]
 codes_collection = db["codes"]
 transactions_collection = db["transactions"]
 user_profiles_collection = db["user_profiles"]
+change_stream_state_collection = db["change_stream_state"]
+rollups_collection = db["transaction_rollups"]
 
 # Rate limiting and cooldown settings
 RATE_LIMIT = {
@@ -32,15 +56,964 @@ COOLDOWN_PERIODS = {
     "balance_check": 60
 }
 
+# Degraded mode settings
+JOURNAL = {
+    "path": os.getenv("JOURNAL_PATH", "journal.db"),
+    "failure_threshold": 3,  # Consecutive database failures before the breaker opens
+    "reset_timeout": 10,  # Seconds before a single trial request is let through
+    "replay_interval": 5  # Seconds between attempts to replay queued intents
+}
+
+# Transaction log batching settings
+TRANSACTION_BATCHING = {
+    "enabled": os.getenv("TRANSACTION_BATCHING", "true").lower() == "true",
+    "max_batch_size": 100,  # Flush once this many records are queued
+    "flush_interval": 0.25  # Maximum seconds a record waits before flushing
+}
+
+# Change stream settings
+CHANGE_STREAMS = {
+    "enabled": os.getenv("CHANGE_STREAMS", "true").lower() == "true",
+    "instance_name": os.getenv("INSTANCE_NAME", socket.gethostname()),
+    "token_save_interval": 5,  # Seconds between resume token saves
+    "retry_delay": 5,  # Seconds to wait before reopening a failed stream
+    "open_timeout": 10  # Seconds to wait for the stream to open at startup
+}
+
+# Reporting rollup settings
+ROLLUP_GRANULARITIES = {
+    "hour": "%Y-%m-%dT%H",  # Bucket ID format, also used by backfill
+    "day": "%Y-%m-%d"
+}
+ROLLUP_FIELDS = [
+    "redeemed_amount",
+    "codes_redeemed",
+    "withdrawals_requested",
+    "withdrawal_amount_requested",
+    "withdrawals_approved",
+    "withdrawal_amount_approved",
+    "withdrawals_rejected"
+]
+ROLLUP_SKETCH_BITS = 10  # 1024 registers per bucket, about 3% error on unique user counts
+
+# Unique user sketches
+def sketch_register(user_id):
+    """Return the (register, rank) a user ID sets in a HyperLogLog sketch."""
+    value = int.from_bytes(hashlib.sha1(str(user_id).encode()).digest()[:8], "big")
+    remaining_bits = 64 - ROLLUP_SKETCH_BITS
+    register = value >> remaining_bits
+    rest = value & ((1 << remaining_bits) - 1)
+    return register, remaining_bits - rest.bit_length() + 1
+
+def merge_sketches(sketches):
+    """Combine sketches stored as {"<register>": rank} into one."""
+    merged = {}
+    for sketch in sketches:
+        for register, rank in sketch.items():
+            if rank > merged.get(register, 0):
+                merged[register] = rank
+    return merged
+
+def estimate_unique(sketch):
+    """Estimate the number of distinct user IDs added to a sketch."""
+    registers = 1 << ROLLUP_SKETCH_BITS
+    alpha = 0.7213 / (1 + 1.079 / registers)
+    total = sum(2.0 ** -rank for rank in sketch.values()) + (registers - len(sketch))
+    estimate = alpha * registers * registers / total
+    empty = registers - len(sketch)
+    if estimate <= 2.5 * registers and empty:
+        # Linear counting is more accurate for small counts
+        estimate = registers * math.log(registers / empty)
+    return round(estimate)
+
+# Transaction Rollups
+class TransactionRollups:
+    """Hourly and daily totals for reporting, kept alongside the transaction log.
+
+    Each bucket document is keyed by "<granularity>:<start>", so a range of
+    buckets is a single _id range query. Withdrawal outcomes are counted in
+    the bucket of the original request, which matches what backfill produces.
+    Unique users are tracked with a fixed-size sketch rather than a list of IDs.
+    """
+
+    def __init__(self, collection, transactions):
+        self.collection = collection
+        self.transactions = transactions
+
+    @staticmethod
+    def bucket_id(granularity, timestamp):
+        return f"{granularity}:{timestamp.strftime(ROLLUP_GRANULARITIES[granularity])}"
+
+    @staticmethod
+    def bucket_start(granularity, timestamp):
+        if granularity == "hour":
+            return timestamp.replace(minute=0, second=0, microsecond=0)
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def record(self, events):
+        """Apply (timestamp, user_id, increments) events to their buckets."""
+        requests = []
+        for timestamp, user_id, increments in events:
+            if not increments:
+                continue
+            register, rank = sketch_register(user_id)
+            for granularity in ROLLUP_GRANULARITIES:
+                requests.append(UpdateOne(
+                    {"_id": self.bucket_id(granularity, timestamp)},
+                    {
+                        "$inc": increments,
+                        "$max": {f"sketch.{register}": rank},
+                        "$setOnInsert": {
+                            "granularity": granularity,
+                            "start": self.bucket_start(granularity, timestamp)
+                        }
+                    },
+                    upsert=True
+                ))
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    def backfill(self, cutoff):
+        """Rebuild every bucket that ends before cutoff from the transaction history.
+
+        Buckets from the cutoff onwards are left alone, since live updates are
+        still landing in them. cutoff must fall on a day boundary.
+        """
+        match = {"type": {"$in": ["code_redeem", "withdrawal"]}, "timestamp": {"$lt": cutoff}}
+        is_redeem = {"$eq": ["$type", "code_redeem"]}
+        is_withdrawal = {"$eq": ["$type", "withdrawal"]}
+        is_approved = {"$and": [is_withdrawal, {"$eq": ["$status", "completed"]}]}
+        is_rejected = {"$and": [is_withdrawal, {"$eq": ["$status", "rejected"]}]}
+
+        for granularity, date_format in ROLLUP_GRANULARITIES.items():
+            self.transactions.aggregate([
+                {"$match": match},
+                {"$group": {
+                    "_id": {"$dateTrunc": {"date": "$timestamp", "unit": granularity}},
+                    "redeemed_amount": {"$sum": {"$cond": [is_redeem, "$amount", 0]}},
+                    "codes_redeemed": {"$sum": {"$cond": [is_redeem, 1, 0]}},
+                    "withdrawals_requested": {"$sum": {"$cond": [is_withdrawal, 1, 0]}},
+                    "withdrawal_amount_requested": {"$sum": {"$cond": [is_withdrawal, "$amount", 0]}},
+                    "withdrawals_approved": {"$sum": {"$cond": [is_approved, 1, 0]}},
+                    "withdrawal_amount_approved": {"$sum": {"$cond": [is_approved, "$amount", 0]}},
+                    "withdrawals_rejected": {"$sum": {"$cond": [is_rejected, 1, 0]}}
+                }},
+                {"$set": {
+                    "start": "$_id",
+                    "granularity": granularity,
+                    "_id": {"$concat": [
+                        f"{granularity}:",
+                        {"$dateToString": {"date": "$_id", "format": date_format}}
+                    ]}
+                }},
+                {"$merge": {"into": self.collection.name, "whenMatched": "replace", "whenNotMatched": "insert"}}
+            ])
+            self._backfill_sketches(granularity, match)
+
+    def _backfill_sketches(self, granularity, match):
+        # Distinct (bucket, user) pairs arrive sorted by bucket, so one sketch is built at a time
+        pairs = self.transactions.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {
+                "start": {"$dateTrunc": {"date": "$timestamp", "unit": granularity}},
+                "user_id": "$user_id"
+            }}},
+            {"$sort": {"_id.start": 1}}
+        ], allowDiskUse=True)
+
+        requests = []
+        start, sketch = None, {}
+        for pair in pairs:
+            if pair["_id"]["start"] != start:
+                if start is not None:
+                    requests.append(UpdateOne({"_id": self.bucket_id(granularity, start)}, {"$set": {"sketch": sketch}}))
+                start, sketch = pair["_id"]["start"], {}
+            register, rank = sketch_register(pair["_id"]["user_id"])
+            sketch[str(register)] = max(sketch.get(str(register), 0), rank)
+            if len(requests) >= 500:
+                self.collection.bulk_write(requests, ordered=False)
+                requests = []
+        if start is not None:
+            requests.append(UpdateOne({"_id": self.bucket_id(granularity, start)}, {"$set": {"sketch": sketch}}))
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+    def read(self, granularity, start, end):
+        """Return bucket documents with start <= bucket < end."""
+        return list(self.collection.find({
+            "_id": {
+                "$gte": self.bucket_id(granularity, start),
+                "$lt": self.bucket_id(granularity, end)
+            }
+        }))
+
+def rollup_event(transaction):
+    """Rollup event for a newly logged transaction."""
+    increments = {}
+    if transaction["type"] == "code_redeem":
+        increments = {"redeemed_amount": transaction["amount"], "codes_redeemed": 1}
+    elif transaction["type"] == "withdrawal":
+        increments = {"withdrawals_requested": 1, "withdrawal_amount_requested": transaction["amount"]}
+    return transaction["timestamp"], transaction["user_id"], increments
+
+def withdrawal_outcome_event(transaction, status):
+    """Rollup event for a pending withdrawal being approved or rejected."""
+    if status == "completed":
+        increments = {"withdrawals_approved": 1, "withdrawal_amount_approved": transaction["amount"]}
+    else:
+        increments = {"withdrawals_rejected": 1}
+    return transaction["timestamp"], transaction["user_id"], increments
+
+transaction_rollups = TransactionRollups(rollups_collection, transactions_collection)
+
+def record_rollups(records):
+    """Add newly stored transaction records to the reporting rollups."""
+    try:
+        transaction_rollups.record([rollup_event(record) for record in records])
+    except PyMongoError as e:
+        print(f"Failed to update transaction rollups: {e}")
+
+# Transaction Log Writer
+class TransactionLogWriter:
+    """Buffer transaction records and write them to MongoDB with insert_many.
+
+    Callers await submit(), which only returns once the record has been
+    flushed, so a balance change is never acknowledged before its ledger row
+    is stored.
+    """
+
+    def __init__(self, collection, max_batch_size, flush_interval, after_flush=None):
+        self.collection = collection
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.after_flush = after_flush
+        self.queue = None
+        self.task = None
+        self.stopping = False
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self):
+        """Start the background flush loop on the running event loop."""
+        if self.running:
+            return
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still queued and stop the flush loop."""
+        if not self.running:
+            return
+        # From here on submit() writes directly, so nothing new lands in the queue
+        self.stopping = True
+        await self.queue.put(None)
+        await self.task
+        await self._drain()
+        self.task = None
+        self.stopping = False
+
+    async def submit(self, record):
+        """Queue a record and wait until it has been written."""
+        if not self.running or self.stopping:
+            await asyncio.to_thread(self.collection.insert_one, record)
+            if self.after_flush:
+                await asyncio.to_thread(self.after_flush, [record])
+            return
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((record, future))
+        await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+
+            # Collect more records until the batch is full or the interval ends
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+        await self._drain()
+
+    async def _drain(self):
+        # Flush anything queued behind the stop marker until the queue is really empty
+        while not self.queue.empty():
+            remaining = []
+            while not self.queue.empty() and len(remaining) < self.max_batch_size:
+                item = self.queue.get_nowait()
+                if item is not None:
+                    remaining.append(item)
+            if remaining:
+                await self._flush(remaining)
+
+    async def _flush(self, batch):
+        records = [record for record, _ in batch]
+        failed = {}
+        try:
+            await asyncio.to_thread(self.collection.insert_many, records, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed[write_error["index"]] = e
+        except Exception as e:
+            print(f"Failed to flush transaction log: {e}")
+            failed = {index: e for index in range(len(batch))}
+
+        for index, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if index in failed:
+                future.set_exception(failed[index])
+            else:
+                future.set_result(None)
+
+        stored = [record for index, record in enumerate(records) if index not in failed]
+        if self.after_flush and stored:
+            await asyncio.to_thread(self.after_flush, stored)
+
+transaction_writer = TransactionLogWriter(
+    transactions_collection,
+    TRANSACTION_BATCHING["max_batch_size"],
+    TRANSACTION_BATCHING["flush_interval"],
+    after_flush=record_rollups
+)
+
+# Reloadable Cache
+def locked(method):
+    """Run a cache method while holding the cache's lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class ReloadableCache:
+    """Base for in-memory caches that are periodically rebuilt from MongoDB.
+
+    Changes applied while a reload is fetching its snapshot are buffered and
+    replayed on top of the snapshot, so they are not lost when it replaces
+    the old data. Caches are also updated from worker threads running
+    database calls, so every access goes through a lock. Subclasses
+    implement fetch(), which returns the arguments for replace().
+    """
+
+    def __init__(self):
+        self.buffered = None
+        self.lock = threading.RLock()
+        self.reload_lock = asyncio.Lock()
+        self.reload_pending = False
+
+    def _buffer(self, method, *args):
+        if self.buffered is not None:
+            self.buffered.append((method, args))
+
+    def schedule_reload(self):
+        """Reload in the background, unless a reload is already waiting to start."""
+        if self.reload_pending:
+            return
+        self.reload_pending = True
+        asyncio.create_task(self.reload())
+
+    async def reload(self):
+        """Rebuild the cache from the database without blocking the bot."""
+        async with self.reload_lock:
+            # Requests made from here on need a newer snapshot than this one
+            self.reload_pending = False
+            with self.lock:
+                self.buffered = []
+            try:
+                with pymongo.timeout(MONGODB_LONG_TIMEOUT):
+                    snapshot = await asyncio.to_thread(self.fetch)
+            except BaseException:
+                with self.lock:
+                    self.buffered = None
+                raise
+            with self.lock:
+                buffered, self.buffered = self.buffered, None
+                self.replace(*snapshot)
+                for method, args in buffered:
+                    method(*args)
+
+# XP Leaderboard
+class XPLeaderboard(ReloadableCache):
+    """In-memory XP standings kept sorted as profiles gain XP.
+
+    Entries are stored as (-xp, user_id) so the list is ordered from highest
+    to lowest XP, with ties broken by user ID.
+    """
+
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+        self.entries = []
+        self.xp_by_user = {}
+        # Delete events only carry the document _id
+        self.user_by_doc = {}
+
+    @locked
+    def __len__(self):
+        return len(self.entries)
+
+    def fetch(self):
+        """Read the XP of every stored profile and the document it came from."""
+        xp_by_user = {}
+        user_by_doc = {}
+        for profile in self.collection.find({}, {"user_id": 1, "xp": 1}):
+            xp_by_user[profile["user_id"]] = profile.get("xp", 0)
+            user_by_doc[profile["_id"]] = profile["user_id"]
+        return xp_by_user, user_by_doc
+
+    @locked
+    def replace(self, xp_by_user, user_by_doc=None):
+        """Rebuild the standings from a user ID to XP mapping."""
+        self.xp_by_user = xp_by_user
+        self.user_by_doc = user_by_doc or {}
+        self.entries = sorted((-xp, user_id) for user_id, xp in xp_by_user.items())
+
+    @locked
+    def update(self, user_id, xp, doc_id=None):
+        """Record a user's new XP total and move them to their new position."""
+        user_id = str(user_id)
+        self._buffer(self.update, user_id, xp, doc_id)
+        if doc_id is not None:
+            self.user_by_doc[doc_id] = user_id
+        old_xp = self.xp_by_user.get(user_id)
+        if old_xp == xp:
+            return
+        if old_xp is not None:
+            index = bisect.bisect_left(self.entries, (-old_xp, user_id))
+            if index < len(self.entries) and self.entries[index] == (-old_xp, user_id):
+                del self.entries[index]
+        bisect.insort(self.entries, (-xp, user_id))
+        self.xp_by_user[user_id] = xp
+
+    @locked
+    def remove(self, user_id):
+        """Drop a user from the standings."""
+        user_id = str(user_id)
+        self._buffer(self.remove, user_id)
+        self._remove(user_id)
+
+    @locked
+    def remove_document(self, doc_id):
+        """Drop the user whose profile document was deleted."""
+        self._buffer(self.remove_document, doc_id)
+        user_id = self.user_by_doc.pop(doc_id, None)
+        if user_id is not None:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        old_xp = self.xp_by_user.pop(user_id, None)
+        if old_xp is None:
+            return
+        index = bisect.bisect_left(self.entries, (-old_xp, user_id))
+        if index < len(self.entries) and self.entries[index] == (-old_xp, user_id):
+            del self.entries[index]
+
+    @locked
+    def top(self, count, offset=0):
+        """Return (user_id, xp) pairs for a slice of the standings."""
+        return [(user_id, -neg_xp) for neg_xp, user_id in self.entries[offset:offset + count]]
+
+    @locked
+    def position(self, user_id):
+        """Return a user's 1-based position, or None if they have no profile."""
+        standing = self.standing(user_id)
+        return standing[0] if standing else None
+
+    @locked
+    def standing(self, user_id):
+        """Return a user's (position, xp), or None if they have no profile."""
+        user_id = str(user_id)
+        xp = self.xp_by_user.get(user_id)
+        if xp is None:
+            return None
+        return bisect.bisect_left(self.entries, (-xp, user_id)) + 1, xp
+
+xp_leaderboard = XPLeaderboard(user_profiles_collection)
+
+# Active Code Cache
+class ActiveCodeCache(ReloadableCache):
+    """In-memory set of unredeemed codes and their amounts."""
+
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+        self.codes = {}
+        # Delete events only carry the document _id
+        self.code_by_doc = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self.codes
+
+    def fetch(self):
+        """Read every unredeemed code and the document it came from."""
+        codes = {}
+        code_by_doc = {}
+        for code in self.collection.find({"redeemed": False}, {"code": 1, "amount": 1}):
+            codes[code["code"]] = code["amount"]
+            code_by_doc[code["_id"]] = code["code"]
+        return codes, code_by_doc
+
+    @locked
+    def replace(self, codes, code_by_doc=None):
+        self.codes = codes
+        self.code_by_doc = code_by_doc or {}
+
+    @locked
+    def add(self, code, amount, doc_id=None):
+        self._buffer(self.add, code, amount, doc_id)
+        self.codes[code] = amount
+        if doc_id is not None:
+            self.code_by_doc[doc_id] = code
+
+    @locked
+    def get(self, code):
+        return self.codes.get(code)
+
+    @locked
+    def discard(self, code, doc_id=None):
+        self._buffer(self.discard, code, doc_id)
+        self.codes.pop(code, None)
+        if doc_id is not None:
+            self.code_by_doc.pop(doc_id, None)
+
+    @locked
+    def discard_document(self, doc_id):
+        """Drop the code whose document was deleted."""
+        self._buffer(self.discard_document, doc_id)
+        code = self.code_by_doc.pop(doc_id, None)
+        if code is not None:
+            self.codes.pop(code, None)
+
+active_codes = ActiveCodeCache(codes_collection)
+
+# Change Stream Watcher
+class ChangeStreamWatcher:
+    """Follow MongoDB change streams and push changes into local caches.
+
+    The stream is read on a worker thread. Change handlers run on the event
+    loop, so caches are only ever modified from the loop. The resume token is
+    saved per instance so a restart picks up where the last run stopped.
+    """
+
+    # Errors that mean change streams can never work here, e.g. a standalone server
+    FATAL_ERROR_CODES = (40573, 280)
+
+    def __init__(self, database, state_collection, instance_name, token_save_interval, retry_delay):
+        self.database = database
+        self.state_collection = state_collection
+        self.instance_name = instance_name
+        self.token_save_interval = token_save_interval
+        self.retry_delay = retry_delay
+        self.handlers = {}
+        self.resync_handlers = []
+        self.stop_event = threading.Event()
+        self.opened_event = threading.Event()
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def register(self, collection_name, handler):
+        """Call handler(change) on the event loop for each change to a collection."""
+        self.handlers.setdefault(collection_name, []).append(handler)
+
+    def register_resync(self, handler):
+        """Await handler() when events were missed and caches must be rebuilt."""
+        self.resync_handlers.append(handler)
+
+    def start(self):
+        """Start following the change streams on a worker thread."""
+        if self.running or not self.handlers:
+            return
+        self.stop_event.clear()
+        self.opened_event.clear()
+        loop = asyncio.get_running_loop()
+        self.task = asyncio.create_task(asyncio.to_thread(self._watch, loop))
+
+    async def wait_until_open(self, timeout):
+        """Wait until the stream is open, so later events are not missed."""
+        if self.running:
+            await asyncio.to_thread(self.opened_event.wait, timeout)
+
+    async def stop(self):
+        """Stop following the change streams and save the resume token."""
+        if not self.running:
+            return
+        self.stop_event.set()
+        await self.task
+        self.task = None
+
+    def _load_token(self):
+        state = self.state_collection.find_one({"instance": self.instance_name})
+        return state.get("resume_token") if state else None
+
+    def _save_token(self, token):
+        self.state_collection.update_one(
+            {"instance": self.instance_name},
+            {"$set": {"resume_token": token, "updated_at": datetime.now(UTC)}},
+            upsert=True
+        )
+
+    def _dispatch(self, loop, change):
+        for handler in self.handlers.get(change["ns"]["coll"], []):
+            loop.call_soon_threadsafe(handler, change)
+
+    def _resync(self, loop):
+        for handler in self.resync_handlers:
+            asyncio.run_coroutine_threadsafe(handler(), loop)
+
+    def _watch(self, loop):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self.handlers)}}}]
+        token = None
+        invalidated = False
+        try:
+            token = self._load_token()
+        except PyMongoError as e:
+            print(f"Failed to load change stream resume token: {e}")
+        saved_token = token
+
+        while not self.stop_event.is_set():
+            try:
+                # After an invalidate event the stream can only be reopened with start_after
+                with self.database.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=None if invalidated else token,
+                    start_after=token if invalidated else None,
+                    max_await_time_ms=1000
+                ) as stream:
+                    self.opened_event.set()
+                    invalidated = False
+                    last_save = time.monotonic()
+                    while not self.stop_event.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self._dispatch(loop, change)
+                        token = stream.resume_token
+                        if not stream.alive:
+                            # The stream was invalidated, e.g. by a dropped or renamed database
+                            print("Change stream invalidated, reopening and resyncing caches")
+                            invalidated = True
+                            self._resync(loop)
+                            break
+                        if token != saved_token and time.monotonic() - last_save >= self.token_save_interval:
+                            self._save_token(token)
+                            saved_token = token
+                            last_save = time.monotonic()
+            except OperationFailure as e:
+                if e.code in (260, 286):
+                    # The saved token is invalid or too old, so start fresh and rebuild caches
+                    print(f"Change stream history lost, resyncing caches: {e}")
+                    token = None
+                    invalidated = False
+                    self._resync(loop)
+                    continue
+                if e.code in self.FATAL_ERROR_CODES:
+                    print(f"Change streams unavailable: {e}")
+                    break
+                # Timeouts and other transient failures resume from the last token
+                print(f"Change stream interrupted: {e}")
+                self.stop_event.wait(self.retry_delay)
+            except PyMongoError as e:
+                print(f"Change stream interrupted: {e}")
+                self.stop_event.wait(self.retry_delay)
+
+        # Don't leave anyone waiting for a stream that will never open
+        self.opened_event.set()
+
+        if token is not None and token != saved_token:
+            try:
+                self._save_token(token)
+            except PyMongoError as e:
+                print(f"Failed to save change stream resume token: {e}")
+
+def handle_profile_change(change):
+    """Keep the leaderboard in step with profile changes from any source."""
+    profile = change.get("fullDocument")
+    if change["operationType"] in ("insert", "update", "replace") and profile:
+        xp_leaderboard.update(profile["user_id"], profile.get("xp", 0), profile["_id"])
+    elif change["operationType"] == "delete":
+        xp_leaderboard.remove_document(change["documentKey"]["_id"])
+    elif change["operationType"] in ("drop", "invalidate"):
+        xp_leaderboard.schedule_reload()
+
+def handle_code_change(change):
+    """Keep the active code cache in step with code changes from any source."""
+    code = change.get("fullDocument")
+    if change["operationType"] in ("insert", "update", "replace") and code:
+        if code.get("redeemed"):
+            active_codes.discard(code["code"], code["_id"])
+        else:
+            active_codes.add(code["code"], code["amount"], code["_id"])
+    elif change["operationType"] == "delete":
+        active_codes.discard_document(change["documentKey"]["_id"])
+    elif change["operationType"] in ("drop", "invalidate"):
+        active_codes.schedule_reload()
+
+async def resync_caches():
+    await xp_leaderboard.reload()
+    await active_codes.reload()
+
+change_watcher = ChangeStreamWatcher(
+    db,
+    change_stream_state_collection,
+    CHANGE_STREAMS["instance_name"],
+    CHANGE_STREAMS["token_save_interval"],
+    CHANGE_STREAMS["retry_delay"]
+)
+change_watcher.register("user_profiles", handle_profile_change)
+change_watcher.register("codes", handle_code_change)
+change_watcher.register_resync(resync_caches)
+
+# Circuit Breaker
+class CircuitBreaker:
+    """Stop calling MongoDB after repeated failures until it has had time to recover."""
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Return True if a database call should be attempted."""
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # Let one trial call through and keep the breaker open for everyone else
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                print("MongoDB circuit breaker opened")
+            self.opened_at = time.monotonic()
+
+def is_unavailable_error(error):
+    """Return True if a database error means MongoDB is unreachable or too slow."""
+    return isinstance(error, (ConnectionFailure, ExecutionTimeout)) or error.timeout
+
+mongo_breaker = CircuitBreaker(JOURNAL["failure_threshold"], JOURNAL["reset_timeout"])
+
+# Intent Journal
+class IntentJournal:
+    """Local SQLite write-ahead journal for redemptions and withdrawals.
+
+    Intents are stored while MongoDB is unavailable and replayed once it
+    recovers. The intent ID doubles as the transaction ID, which is what
+    makes replaying an intent more than once safe.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS intents ("
+            "intent_id TEXT PRIMARY KEY, "
+            "kind TEXT NOT NULL, "
+            "user_id TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "created_at TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS intents_by_user ON intents (user_id, kind, created_at)"
+        )
+        self.connection.commit()
+
+    def append(self, kind, user_id, payload, intent_id=None, created_at=None):
+        """Durably store an intent and return its ID.
+
+        Pass intent_id and created_at to finish a transaction that was
+        already started online under that ID.
+        """
+        intent_id = intent_id or ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+        created_at = created_at or datetime.now(UTC)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO intents (intent_id, kind, user_id, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                (intent_id, kind, str(user_id), json.dumps(payload), created_at.isoformat())
+            )
+        return intent_id
+
+    def pending(self):
+        """Return queued intents, oldest first."""
+        rows = self.connection.execute(
+            "SELECT intent_id, kind, user_id, payload, created_at FROM intents ORDER BY created_at, rowid"
+        ).fetchall()
+        return [
+            {
+                "intent_id": intent_id,
+                "kind": kind,
+                "user_id": user_id,
+                "payload": json.loads(payload),
+                "created_at": datetime.fromisoformat(created_at)
+            }
+            for intent_id, kind, user_id, payload, created_at in rows
+        ]
+
+    def has_pending_code(self, code):
+        """Return True if a redemption of this code is already queued."""
+        return self.connection.execute(
+            "SELECT 1 FROM intents WHERE kind = 'code_redeem' AND json_extract(payload, '$.code') = ?",
+            (code,)
+        ).fetchone() is not None
+
+    def recent_count(self, user_id, kind, period):
+        """Count a user's queued intents of one kind within a period."""
+        since = (datetime.now(UTC) - period).isoformat()
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM intents WHERE user_id = ? AND kind = ? AND created_at >= ?",
+            (str(user_id), kind, since)
+        ).fetchone()[0]
+
+    def remove(self, intent_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM intents WHERE intent_id = ?", (intent_id,))
+
+    def close(self):
+        self.connection.close()
+
+intent_journal = IntentJournal(JOURNAL["path"])
+
+# Journal Replayer
+class JournalReplayer:
+    """Replay queued intents against MongoDB whenever the breaker allows it."""
+
+    def __init__(self, journal, breaker, interval):
+        self.journal = journal
+        self.breaker = breaker
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    async def _run(self):
+        # Withdrawals are posted to a guild channel, which needs the gateway to be ready
+        await bot.wait_until_ready()
+        while True:
+            await self.replay()
+            await asyncio.sleep(self.interval)
+
+    async def replay(self):
+        """Apply queued intents in order, stopping at the first database failure."""
+        intents = self.journal.pending()
+        if not intents or not self.breaker.allow():
+            return
+        for intent in intents:
+            try:
+                if intent["kind"] == "code_redeem":
+                    finished = await replay_redemption(intent)
+                else:
+                    finished = await replay_withdrawal(intent)
+            except PyMongoError as e:
+                print(f"Failed to replay intent {intent['intent_id']}: {e}")
+                if is_unavailable_error(e):
+                    self.breaker.record_failure()
+                    return
+                # Leave the intent queued for a later attempt and carry on with the rest
+                continue
+            self.breaker.record_success()
+            if finished:
+                self.journal.remove(intent["intent_id"])
+
+journal_replayer = JournalReplayer(intent_journal, mongo_breaker, JOURNAL["replay_interval"])
+
 # Discord bot setup
+class CashbackBot(commands.Bot):
+    async def setup_hook(self):
+        """Start background workers before connecting to Discord."""
+        # Watch for changes before loading caches so nothing is missed in between
+        if CHANGE_STREAMS["enabled"]:
+            change_watcher.start()
+            await change_watcher.wait_until_open(CHANGE_STREAMS["open_timeout"])
+        try:
+            await resync_caches()
+        except PyMongoError as e:
+            print(f"Failed to load caches, starting in degraded mode: {e}")
+            if is_unavailable_error(e):
+                mongo_breaker.record_failure()
+        if TRANSACTION_BATCHING["enabled"]:
+            transaction_writer.start()
+        journal_replayer.start()
+
+    async def close(self):
+        """Stop taking interactions, then drain background workers."""
+        await journal_replayer.stop()
+        # Closing the gateway first means no new interaction can reach the journal
+        await super().close()
+        # Let in-flight redemptions and withdrawals finish
+        for lock in list(user_locks.values()):
+            async with lock:
+                pass
+        await transaction_writer.stop()
+        await change_watcher.stop()
+        intent_journal.close()
+
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="$", intents=intents)
+bot = CashbackBot(command_prefix="$", intents=intents)
 
 # Helper Functions
 def generate_code(length=8):
     """Generate a random alphanumeric code."""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
+# One lock per user so a user's redemptions and withdrawals run one at a time
+user_locks = weakref.WeakValueDictionary()
+
+def get_user_lock(user_id):
+    """Return the lock serializing balance changes for a user."""
+    lock = user_locks.get(str(user_id))
+    if lock is None:
+        lock = asyncio.Lock()
+        user_locks[str(user_id)] = lock
+    return lock
+
 def get_or_create_user(user_id):
     """Retrieve or create a user record with enhanced profile."""
     user = users_collection.find_one({"user_id": str(user_id)})
@@ -67,21 +1040,64 @@ def get_or_create_user(user_id):
             "transaction_count": 0
         }
         user_profiles_collection.insert_one(profile)
+        xp_leaderboard.update(user_id, 0)
     return user
 
-def create_transaction(user_id, amount, transaction_type, status="completed"):
-    """Create a transaction record."""
+async def create_transaction(user_id, amount, transaction_type, status="completed",
+                             transaction_id=None, timestamp=None):
+    """Create a transaction record and wait until it is stored."""
     transaction = {
         "user_id": str(user_id),
         "amount": amount,
         "type": transaction_type,
         "status": status,
-        "timestamp": datetime.now(UTC),
-        "transaction_id": ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+        "timestamp": timestamp or datetime.now(UTC),
+        "transaction_id": transaction_id or ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
     }
-    transactions_collection.insert_one(transaction)
+    await transaction_writer.submit(transaction)
     return transaction
 
+def record_outcome_rollup(transaction, status):
+    """Add a withdrawal approval or rejection to the reporting rollups."""
+    try:
+        transaction_rollups.record([withdrawal_outcome_event(transaction, status)])
+    except PyMongoError as e:
+        print(f"Failed to update transaction rollups: {e}")
+
+def parse_report_range(value, now):
+    """Turn a report range into (granularity, start, end, label).
+
+    Accepts "<n>h", "<n>d", "YYYY-MM-DD" or "YYYY-MM-DD:YYYY-MM-DD".
+    Returns None if the range can't be parsed.
+    """
+    value = value.strip().lower()
+    try:
+        if value.endswith("h") and value[:-1].isdigit():
+            hours = int(value[:-1])
+            if not 1 <= hours <= 24 * 7:
+                return None
+            end = TransactionRollups.bucket_start("hour", now) + timedelta(hours=1)
+            return "hour", end - timedelta(hours=hours), end, f"Last {hours} hour(s)"
+        if value.endswith("d") and value[:-1].isdigit():
+            days = int(value[:-1])
+            if not 1 <= days <= 366:
+                return None
+            end = TransactionRollups.bucket_start("day", now) + timedelta(days=1)
+            return "day", end - timedelta(days=days), end, f"Last {days} day(s)"
+        first, _, last = value.partition(":")
+        start = datetime.strptime(first, "%Y-%m-%d").replace(tzinfo=UTC)
+        end = datetime.strptime(last or first, "%Y-%m-%d").replace(tzinfo=UTC) + timedelta(days=1)
+    except ValueError:
+        return None
+    if end <= start or (end - start).days > 366:
+        return None
+    label = first if not last else f"{first} to {last}"
+    return "day", start, end, label
+
+def level_for_xp(xp):
+    """Return the level reached with this much XP (1000 XP per level)."""
+    return (xp // 1000) + 1
+
 def update_user_profile(user_id, amount, transaction_type):
     """Update user profile with new transaction."""
     profile = user_profiles_collection.find_one({"user_id": str(user_id)})
@@ -92,8 +1108,8 @@ def update_user_profile(user_id, amount, transaction_type):
     xp_gained = int(amount)
     new_xp = profile.get("xp", 0) + xp_gained
     
-    # Level up system (1000 XP per level)
-    new_level = (new_xp // 1000) + 1
+    # Level up system
+    new_level = level_for_xp(new_xp)
     
     # Rank system
     ranks = ["Bronze", "Silver", "Gold", "Platinum", "Diamond"]
@@ -113,6 +1129,7 @@ def update_user_profile(user_id, amount, transaction_type):
             "$inc": {"transaction_count": 1}
         }
     )
+    xp_leaderboard.update(user_id, new_xp)
 
 async def send_notification(user, message, interaction=None):
     """Send notification to user."""
@@ -125,14 +1142,317 @@ async def send_notification(user, message, interaction=None):
     except Exception as e:
         print(f"Failed to send notification: {e}")
 
+async def post_withdrawal_request(guild, member, amount, remaining_balance, transaction_id, category_name, channel_name):
+    """Post a withdrawal request to the private staff channel."""
+    category = discord.utils.get(guild.categories, name=category_name)
+    if not category:
+        category = await guild.create_category(category_name)
+
+    channel = discord.utils.get(category.channels, name=channel_name)
+    if not channel:
+        channel = await category.create_text_channel(channel_name)
+
+    # Set permissions
+    overwrite = PermissionOverwrite()
+    overwrite.read_messages = True
+    await channel.set_permissions(member, overwrite=overwrite)
+
+    overwrite = PermissionOverwrite()
+    overwrite.read_messages = False
+    await channel.set_permissions(guild.default_role, overwrite=overwrite)
+
+    embed = discord.Embed(
+        title="💳 Withdrawal Request",
+        description="A new withdrawal request has been submitted.",
+        color=discord.Color.green(),
+        timestamp=discord.utils.utcnow(),
+    )
+    embed.add_field(name="User", value=f"{member.mention} ({member.id})", inline=False)
+    embed.add_field(name="Amount", value=f"**${amount:.2f}**", inline=True)
+    embed.add_field(name="Transaction ID", value=transaction_id, inline=True)
+    embed.add_field(name="Remaining Balance", value=f"**${remaining_balance:.2f}**", inline=True)
+    embed.set_footer(text="Cashback System")
+
+    server_owner = guild.owner
+    await channel.send(
+        content=f"{server_owner.mention}",
+        embed=embed,
+        view=StaffButtonsView(member.id, amount, remaining_balance, channel, guild, transaction_id)
+    )
+
+async def journal_redemption(interaction, code):
+    """Queue a redemption locally while MongoDB is unavailable."""
+    user_id = str(interaction.user.id)
+    if intent_journal.recent_count(user_id, "code_redeem", timedelta(minutes=1)) >= RATE_LIMIT["code_redeem"]:
+        await interaction.response.send_message(
+            "❌ You've reached the rate limit. Please wait before trying again.",
+            ephemeral=True
+        )
+        return
+
+    # The code itself is checked against the database on replay
+    if intent_journal.has_pending_code(code):
+        await interaction.response.send_message("❌ This code is already queued for redemption.", ephemeral=True)
+        return
+    amount = active_codes.get(code)
+    intent_id = intent_journal.append("code_redeem", user_id, {"code": code})
+
+    if amount is not None:
+        description = f"Your **${amount:.2f}** cashback is queued and will be added to your balance shortly."
+    else:
+        description = "Your code is queued and will be checked and added to your balance shortly."
+    embed = discord.Embed(
+        title="⏳ Code Accepted",
+        description=description,
+        color=discord.Color.orange(),
+        timestamp=discord.utils.utcnow(),
+    )
+    embed.add_field(name="Transaction ID", value=intent_id, inline=False)
+    embed.set_footer(text="Cashback System")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+async def queue_claimed_redemption(interaction, claim):
+    """Queue the rest of a redemption whose code claim was already attempted online.
+
+    The intent reuses the transaction ID written to the code, so replay
+    picks up the claim if it landed and only adds the ledger row and credit
+    that are missing.
+    """
+    intent_journal.append(
+        "code_redeem", claim["user_id"], claim["payload"],
+        intent_id=claim["intent_id"], created_at=claim["created_at"]
+    )
+    if interaction.response.is_done():
+        return
+    if claim["amount"] is not None:
+        description = f"Your **${claim['amount']:.2f}** cashback is queued and will be added to your balance shortly."
+    else:
+        description = "Your code is queued and will be checked and added to your balance shortly."
+    embed = discord.Embed(
+        title="⏳ Code Accepted",
+        description=description,
+        color=discord.Color.orange(),
+        timestamp=discord.utils.utcnow(),
+    )
+    embed.add_field(name="Transaction ID", value=claim["intent_id"], inline=False)
+    embed.set_footer(text="Cashback System")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+async def journal_withdrawal(interaction, amount_text, category_name, channel_name):
+    """Queue a withdrawal request locally while MongoDB is unavailable."""
+    user_id = str(interaction.user.id)
+    if intent_journal.recent_count(user_id, "withdrawal", timedelta(hours=1)) >= RATE_LIMIT["withdrawal"]:
+        await interaction.response.send_message(
+            "❌ You've reached the withdrawal rate limit. Please wait before trying again.",
+            ephemeral=True
+        )
+        return
+
+    try:
+        amount = float(amount_text.strip())
+    except ValueError:
+        await interaction.response.send_message("❌ Invalid amount entered. Please enter a valid number.", ephemeral=True)
+        return
+    if amount < 1.0:
+        await interaction.response.send_message(
+            "❌ Minimum withdrawal amount is $1.00.", ephemeral=True
+        )
+        return
+
+    # The balance is checked when the intent is replayed
+    intent_id = intent_journal.append("withdrawal", user_id, {
+        "amount": amount,
+        "guild_id": interaction.guild.id,
+        "category_name": category_name,
+        "channel_name": channel_name
+    })
+    await interaction.response.send_message(
+        f"⏳ Withdrawal request for **${amount:.2f}** queued (ID: {intent_id}). "
+        "You'll be notified once it has been submitted.",
+        ephemeral=True
+    )
+
+def credit_redemption(user_id, reward, transaction_id):
+    """Add a redemption to a user's balance, at most once per transaction ID."""
+    return users_collection.update_one(
+        {"user_id": user_id, "journal_intents": {"$ne": transaction_id}},
+        {
+            "$inc": {"balance": reward, "total_earned": reward},
+            "$set": {"last_transaction": datetime.now(UTC)},
+            "$push": {"journal_intents": {"$each": [transaction_id], "$slice": -50}}
+        }
+    )
+
+def apply_redemption_intent(intent):
+    """Apply a queued redemption to MongoDB.
+
+    Returns (reward, credited), or None if the code is no longer valid.
+    Every step is safe to repeat if a previous replay was interrupted.
+    """
+    user_id = intent["user_id"]
+    transaction_id = intent["intent_id"]
+    code = intent["payload"]["code"]
+
+    code_data = codes_collection.find_one_and_update(
+        {"code": code, "redeemed": False},
+        {"$set": {
+            "redeemed": True,
+            "redeemed_by": user_id,
+            "redeemed_at": intent["created_at"],
+            "intent_id": transaction_id
+        }}
+    )
+    if not code_data:
+        code_data = codes_collection.find_one({"code": code, "intent_id": transaction_id})
+        if not code_data:
+            return None
+
+    reward = code_data["amount"]
+    result = credit_redemption(user_id, reward, transaction_id)
+
+    transaction = {
+        "user_id": user_id,
+        "amount": reward,
+        "type": "code_redeem",
+        "status": "completed",
+        "timestamp": intent["created_at"],
+        "transaction_id": transaction_id
+    }
+    logged = transactions_collection.update_one(
+        {"transaction_id": transaction_id}, {"$setOnInsert": transaction}, upsert=True
+    )
+    if logged.upserted_id is not None:
+        record_rollups([transaction])
+    return reward, result.modified_count > 0
+
+def apply_withdrawal_intent(intent):
+    """Apply a queued withdrawal to MongoDB.
+
+    Returns the remaining balance, or None if the balance is too low.
+    Every step is safe to repeat if a previous replay was interrupted.
+    """
+    user_id = intent["user_id"]
+    transaction_id = intent["intent_id"]
+    amount = intent["payload"]["amount"]
+
+    result = users_collection.update_one(
+        {"user_id": user_id, "balance": {"$gte": amount}, "journal_intents": {"$ne": transaction_id}},
+        {
+            "$inc": {"balance": -amount, "total_withdrawn": amount},
+            "$set": {"last_transaction": datetime.now(UTC)},
+            "$push": {"journal_intents": {"$each": [transaction_id], "$slice": -50}}
+        }
+    )
+    if not result.matched_count and not users_collection.find_one(
+        {"user_id": user_id, "journal_intents": transaction_id}
+    ):
+        return None
+
+    transaction = {
+        "user_id": user_id,
+        "amount": amount,
+        "type": "withdrawal",
+        "status": "pending",
+        "timestamp": intent["created_at"],
+        "transaction_id": transaction_id
+    }
+    logged = transactions_collection.update_one(
+        {"transaction_id": transaction_id}, {"$setOnInsert": transaction}, upsert=True
+    )
+    if logged.upserted_id is not None:
+        record_rollups([transaction])
+    return users_collection.find_one({"user_id": user_id})["balance"]
+
+async def replay_redemption(intent):
+    """Replay a queued redemption and tell the user how it went.
+
+    Returns True once the intent no longer needs replaying.
+    """
+    user = {"user_id": intent["user_id"]}
+    code = intent["payload"]["code"]
+    await asyncio.to_thread(get_or_create_user, intent["user_id"])
+    outcome = await asyncio.to_thread(apply_redemption_intent, intent)
+    if outcome is None:
+        await send_notification(user, f"❌ Your queued redemption of code `{code}` failed: the code is invalid or already redeemed.")
+        return True
+
+    reward, credited = outcome
+    if credited:
+        await asyncio.to_thread(update_user_profile, intent["user_id"], reward, "code_redeem")
+    active_codes.discard(code)
+    await send_notification(user, f"✅ Your queued redemption of **${reward:.2f}** has been added to your balance! (ID: {intent['intent_id']})")
+    return True
+
+async def replay_withdrawal(intent):
+    """Replay a queued withdrawal and post it for staff review.
+
+    Returns True once the intent no longer needs replaying. The intent is
+    kept until the request has been posted, since staff can't act on it
+    otherwise; applying it again on the next attempt is safe.
+    """
+    user = {"user_id": intent["user_id"]}
+    payload = intent["payload"]
+    amount = payload["amount"]
+    await asyncio.to_thread(get_or_create_user, intent["user_id"])
+    remaining_balance = await asyncio.to_thread(apply_withdrawal_intent, intent)
+    if remaining_balance is None:
+        await send_notification(user, f"❌ Your queued withdrawal of **${amount:.2f}** failed: insufficient balance.")
+        return True
+
+    guild = bot.get_guild(payload["guild_id"])
+    if guild is None:
+        print(f"Failed to post queued withdrawal {intent['intent_id']}: guild {payload['guild_id']} is not available")
+        return False
+    try:
+        member = guild.get_member(int(intent["user_id"])) or await guild.fetch_member(int(intent["user_id"]))
+        await post_withdrawal_request(
+            guild, member, amount, remaining_balance, intent["intent_id"],
+            payload["category_name"], payload["channel_name"]
+        )
+    except discord.HTTPException as e:
+        print(f"Failed to post queued withdrawal {intent['intent_id']}: {e}")
+        return False
+    await send_notification(user, f"✅ Your queued withdrawal request for **${amount:.2f}** has been submitted. Your new balance is **${remaining_balance:.2f}**")
+    return True
+
 # Modal Classes
 class RedeemCodeModal(Modal, title="Redeem Cashback Code"):
     code_input = TextInput(label="Enter your code:", placeholder="e.g., ABC123")
 
     async def on_submit(self, interaction: Interaction):
+        code = self.code_input.value.strip()
+        if not mongo_breaker.allow():
+            await journal_redemption(interaction, code)
+            return
+
+        self.claim = None
+        try:
+            with pymongo.timeout(MONGODB_INTERACTION_TIMEOUT):
+                async with get_user_lock(interaction.user.id):
+                    await self.redeem(interaction, code)
+        except PyMongoError as e:
+            print(f"Database error during redemption: {e}")
+            unavailable = is_unavailable_error(e)
+            if unavailable:
+                mongo_breaker.record_failure()
+            if self.claim is not None:
+                # The claim may have landed, so let the replayer finish it under the same transaction ID
+                await queue_claimed_redemption(interaction, self.claim)
+                return
+            if interaction.response.is_done():
+                return
+            # Nothing was written yet, so the redemption can safely be queued
+            if unavailable:
+                await journal_redemption(interaction, code)
+            else:
+                await interaction.response.send_message("❌ An error occurred while redeeming your code.", ephemeral=True)
+            return
+        mongo_breaker.record_success()
+
+    async def redeem(self, interaction: Interaction, code):
         # Rate limiting check
         user_id = str(interaction.user.id)
-        recent_transactions = transactions_collection.count_documents({
+        recent_transactions = await asyncio.to_thread(transactions_collection.count_documents, {
             "user_id": user_id,
             "type": "code_redeem",
             "timestamp": {"$gte": datetime.now(UTC) - timedelta(minutes=1)}
@@ -145,36 +1465,49 @@ class RedeemCodeModal(Modal, title="Redeem Cashback Code"):
             )
             return
 
-        code = self.code_input.value.strip()
-        code_data = codes_collection.find_one({"code": code, "redeemed": False})
+        # Claim the code atomically so it can only be redeemed once. The
+        # transaction ID is recorded on the code so a replay can find it,
+        # which also covers a claim that timed out after being applied.
+        transaction_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+        claimed_at = datetime.now(UTC)
+        self.claim = {
+            "intent_id": transaction_id,
+            "user_id": user_id,
+            "payload": {"code": code},
+            "created_at": claimed_at,
+            "amount": active_codes.get(code)
+        }
+        code_data = await asyncio.to_thread(
+            codes_collection.find_one_and_update,
+            {"code": code, "redeemed": False},
+            {"$set": {
+                "redeemed": True,
+                "redeemed_by": user_id,
+                "redeemed_at": claimed_at,
+                "intent_id": transaction_id
+            }}
+        )
 
         if not code_data:
+            self.claim = None
             await interaction.response.send_message("❌ Invalid or already redeemed code.", ephemeral=True)
             return
 
+        self.claim["amount"] = code_data["amount"]
+        active_codes.discard(code)
         reward = code_data["amount"]
-        user = get_or_create_user(interaction.user.id)
-        
-        # Update user balance and create transaction
-        users_collection.update_one(
-            {"user_id": user_id},
-            {
-                "$inc": {
-                    "balance": reward,
-                    "total_earned": reward
-                },
-                "$set": {"last_transaction": datetime.now(UTC)}
-            }
+        user = await asyncio.to_thread(get_or_create_user, interaction.user.id)
+
+        # Create transaction record before touching the balance
+        transaction = await create_transaction(
+            user_id, reward, "code_redeem", transaction_id=transaction_id, timestamp=claimed_at
         )
-        
-        # Create transaction record
-        transaction = create_transaction(user_id, reward, "code_redeem")
+
+        # Update user balance, keyed on the transaction ID so a replay can't credit it twice
+        await asyncio.to_thread(credit_redemption, user_id, reward, transaction_id)
         
         # Update user profile
-        update_user_profile(user_id, reward, "code_redeem")
-        
-        # Mark code as redeemed
-        codes_collection.update_one({"code": code}, {"$set": {"redeemed": True}})
+        await asyncio.to_thread(update_user_profile, user_id, reward, "code_redeem")
 
         # Create success embed
         embed = discord.Embed(
@@ -202,9 +1535,34 @@ class WithdrawModal(Modal, title="Withdraw Cashback"):
         self.channel_name = channel_name
 
     async def on_submit(self, interaction: Interaction):
+        if not mongo_breaker.allow():
+            await journal_withdrawal(interaction, self.amount_input.value, self.category_name, self.channel_name)
+            return
+
+        self.writes_started = False
+        try:
+            with pymongo.timeout(MONGODB_INTERACTION_TIMEOUT):
+                async with get_user_lock(interaction.user.id):
+                    await self.withdraw(interaction)
+        except PyMongoError as e:
+            print(f"Database error during withdrawal: {e}")
+            unavailable = is_unavailable_error(e)
+            if unavailable:
+                mongo_breaker.record_failure()
+            if interaction.response.is_done():
+                return
+            # Nothing was written yet, so the request can safely be queued
+            if unavailable and not self.writes_started:
+                await journal_withdrawal(interaction, self.amount_input.value, self.category_name, self.channel_name)
+            else:
+                await interaction.response.send_message("❌ An error occurred while submitting your withdrawal.", ephemeral=True)
+            return
+        mongo_breaker.record_success()
+
+    async def withdraw(self, interaction: Interaction):
         # Rate limiting check
         user_id = str(interaction.user.id)
-        recent_transactions = transactions_collection.count_documents({
+        recent_transactions = await asyncio.to_thread(transactions_collection.count_documents, {
             "user_id": user_id,
             "type": "withdrawal",
             "timestamp": {"$gte": datetime.now(UTC) - timedelta(hours=1)}
@@ -217,7 +1575,7 @@ class WithdrawModal(Modal, title="Withdraw Cashback"):
             )
             return
 
-        user = get_or_create_user(interaction.user.id)
+        user = await asyncio.to_thread(get_or_create_user, interaction.user.id)
         balance = user["balance"]
 
         try:
@@ -237,56 +1595,42 @@ class WithdrawModal(Modal, title="Withdraw Cashback"):
             )
             return
 
-        # Create transaction record
-        transaction = create_transaction(user_id, amount, "withdrawal", status="pending")
-        
-        # Update user balance
-        users_collection.update_one(
-            {"user_id": user_id},
+        # Update user balance only if it still covers the amount
+        self.writes_started = True
+        user = await asyncio.to_thread(
+            users_collection.find_one_and_update,
+            {"user_id": user_id, "balance": {"$gte": amount}},
             {
                 "$inc": {
                     "balance": -amount,
                     "total_withdrawn": amount
                 },
                 "$set": {"last_transaction": datetime.now(UTC)}
-            }
+            },
+            return_document=ReturnDocument.AFTER
         )
+        if not user:
+            await interaction.response.send_message(
+                f"❌ Insufficient balance. You only have **${balance:.2f}**.", ephemeral=True
+            )
+            return
+        balance = user["balance"] + amount
 
-        guild = interaction.guild
-        category = discord.utils.get(guild.categories, name=self.category_name)
-        if not category:
-            category = await guild.create_category(self.category_name)
-
-        channel = discord.utils.get(category.channels, name=self.channel_name)
-        if not channel:
-            channel = await category.create_text_channel(self.channel_name)
-
-        # Set permissions
-        overwrite = PermissionOverwrite()
-        overwrite.read_messages = True
-        await channel.set_permissions(interaction.user, overwrite=overwrite)
-
-        overwrite = PermissionOverwrite()
-        overwrite.read_messages = False
-        await channel.set_permissions(guild.default_role, overwrite=overwrite)
-
-        embed = discord.Embed(
-            title="💳 Withdrawal Request",
-            description="A new withdrawal request has been submitted.",
-            color=discord.Color.green(),
-            timestamp=discord.utils.utcnow(),
-        )
-        embed.add_field(name="User", value=f"{interaction.user.mention} ({interaction.user.id})", inline=False)
-        embed.add_field(name="Amount", value=f"**${amount:.2f}**", inline=True)
-        embed.add_field(name="Transaction ID", value=transaction["transaction_id"], inline=True)
-        embed.add_field(name="Remaining Balance", value=f"**${balance - amount:.2f}**", inline=True)
-        embed.set_footer(text="Cashback System")
+        # Create transaction record
+        try:
+            transaction = await create_transaction(user_id, amount, "withdrawal", status="pending")
+        except PyMongoError:
+            # Refund the amount so the balance matches the ledger
+            await asyncio.to_thread(
+                users_collection.update_one,
+                {"user_id": user_id},
+                {"$inc": {"balance": amount, "total_withdrawn": -amount}}
+            )
+            raise
 
-        server_owner = guild.owner
-        await channel.send(
-            content=f"{server_owner.mention}",
-            embed=embed,
-            view=StaffButtonsView(interaction.user.id, amount, balance - amount, channel, guild, transaction["transaction_id"])
+        await post_withdrawal_request(
+            interaction.guild, interaction.user, amount, balance - amount,
+            transaction["transaction_id"], self.category_name, self.channel_name
         )
 
         # Send notification
@@ -317,10 +1661,12 @@ class StaffButtonsView(View):
             return
 
         # Update transaction status
-        transactions_collection.update_one(
+        transaction = transactions_collection.find_one_and_update(
             {"transaction_id": self.transaction_id},
             {"$set": {"status": "completed"}}
         )
+        if transaction and transaction["status"] == "pending":
+            await asyncio.to_thread(record_outcome_rollup, transaction, "completed")
 
         # Get user for notification
         user = get_or_create_user(self.user_id)
@@ -353,10 +1699,12 @@ class StaffButtonsView(View):
             return
 
         # Update transaction status
-        transactions_collection.update_one(
+        transaction = transactions_collection.find_one_and_update(
             {"transaction_id": self.transaction_id},
             {"$set": {"status": "rejected"}}
         )
+        if transaction and transaction["status"] == "pending":
+            await asyncio.to_thread(record_outcome_rollup, transaction, "rejected")
 
         # Refund the user's balance
         users_collection.update_one(
@@ -562,6 +1910,10 @@ async def view_profile(ctx, member: discord.Member = None):
     embed.add_field(name="Transactions", value=f"**{profile['transaction_count']}**", inline=True)
     embed.add_field(name="Member Since", value=user['created_at'].strftime('%Y-%m-%d'), inline=True)
 
+    position = xp_leaderboard.position(member.id)
+    if position:
+        embed.add_field(name="Leaderboard", value=f"**#{position}** of {len(xp_leaderboard)}", inline=True)
+
     # Add achievements if any
     if profile['achievements']:
         achievements_text = "\n".join([f"🏆 {achievement}" for achievement in profile['achievements']])
@@ -572,6 +1924,43 @@ async def view_profile(ctx, member: discord.Member = None):
 
     await ctx.send(embed=embed, ephemeral=True)
 
+@bot.command(name="leaderboard")
+async def view_leaderboard(ctx, page: int = 1):
+    """View the XP leaderboard and your position on it."""
+    per_page = 10
+    if page < 1:
+        page = 1
+    offset = (page - 1) * per_page
+    standings = xp_leaderboard.top(per_page, offset)
+
+    if not standings:
+        await ctx.send("No leaderboard entries found.", ephemeral=True)
+        return
+
+    embed = discord.Embed(
+        title="🏆 XP Leaderboard",
+        description="Top members ranked by XP",
+        color=discord.Color.gold(),
+        timestamp=discord.utils.utcnow(),
+    )
+
+    lines = []
+    for position, (user_id, xp) in enumerate(standings, start=offset + 1):
+        lines.append(f"**#{position}** <@{user_id}> • Level {level_for_xp(xp)} • {xp} XP")
+    embed.add_field(name="Standings", value="\n".join(lines), inline=False)
+
+    standing = xp_leaderboard.standing(ctx.author.id)
+    if standing:
+        position, xp = standing
+        embed.add_field(name="Your Position", value=f"**#{position}** with {xp} XP", inline=False)
+    else:
+        embed.add_field(name="Your Position", value="Not ranked yet", inline=False)
+
+    total_pages = (len(xp_leaderboard) + per_page - 1) // per_page
+    embed.set_footer(text=f"Page {page}/{total_pages} • Cashback System")
+
+    await ctx.send(embed=embed, ephemeral=True)
+
 @bot.command(name="generate_code")
 @commands.has_role("Staff")
 async def generate_code(ctx, amount: float):
@@ -589,6 +1978,7 @@ async def generate_code(ctx, amount: float):
         "created_by": str(ctx.author.id)
     }
     codes_collection.insert_one(code_data)
+    active_codes.add(code, amount)
 
     embed = discord.Embed(
         title="🎫 New Cashback Code Generated",
@@ -684,14 +2074,13 @@ async def view_withdrawals(ctx, status: str = "pending"):
     embed.set_footer(text="Cashback System")
     await ctx.send(embed=embed, ephemeral=True)
 
-@bot.command(name="stats")
-@commands.has_role("Staff")
-async def view_stats(ctx):
-    """View system statistics."""
-    total_users = users_collection.count_documents({})
-    total_transactions = transactions_collection.count_documents({})
-    total_codes = codes_collection.count_documents({})
-    active_codes = codes_collection.count_documents({"redeemed": False})
+def collect_stats():
+    """Read the counts and totals shown by $stats."""
+    # Collection sizes come from metadata rather than a full scan
+    total_users = users_collection.estimated_document_count()
+    total_transactions = transactions_collection.estimated_document_count()
+    total_codes = codes_collection.estimated_document_count()
+    active_code_count = codes_collection.count_documents({"redeemed": False})
     pending_withdrawals = transactions_collection.count_documents({"type": "withdrawal", "status": "pending"})
     
     # Calculate total amounts
@@ -704,6 +2093,20 @@ async def view_stats(ctx):
         }}
     ]
     totals = list(users_collection.aggregate(pipeline))[0]
+    return total_users, total_transactions, total_codes, active_code_count, pending_withdrawals, totals
+
+@bot.command(name="stats")
+@commands.has_role("Staff")
+async def view_stats(ctx):
+    """View system statistics."""
+    try:
+        with pymongo.timeout(MONGODB_LONG_TIMEOUT):
+            stats = await asyncio.to_thread(collect_stats)
+    except PyMongoError as e:
+        print(f"Failed to collect statistics: {e}")
+        await ctx.send("❌ Failed to collect statistics.", ephemeral=True)
+        return
+    total_users, total_transactions, total_codes, active_code_count, pending_withdrawals, totals = stats
 
     embed = discord.Embed(
         title="📊 System Statistics",
@@ -714,7 +2117,7 @@ async def view_stats(ctx):
 
     embed.add_field(name="Total Users", value=f"**{total_users}**", inline=True)
     embed.add_field(name="Total Transactions", value=f"**{total_transactions}**", inline=True)
-    embed.add_field(name="Active Codes", value=f"**{active_codes}/{total_codes}**", inline=True)
+    embed.add_field(name="Active Codes", value=f"**{active_code_count}/{total_codes}**", inline=True)
     embed.add_field(name="Pending Withdrawals", value=f"**{pending_withdrawals}**", inline=True)
     embed.add_field(name="Total Earned", value=f"**${totals['total_earned']:.2f}**", inline=True)
     embed.add_field(name="Total Withdrawn", value=f"**${totals['total_withdrawn']:.2f}**", inline=True)
@@ -723,6 +2126,64 @@ async def view_stats(ctx):
     embed.set_footer(text="Cashback System")
     await ctx.send(embed=embed, ephemeral=True)
 
+@bot.command(name="report")
+@commands.has_role("Staff")
+async def view_report(ctx, time_range: str = "7d"):
+    """View earnings and withdrawal totals for a time range."""
+    parsed = parse_report_range(time_range, datetime.now(UTC))
+    if not parsed:
+        await ctx.send("❌ Invalid range. Use e.g. `24h`, `7d`, `2025-01-01` or `2025-01-01:2025-01-31`.", ephemeral=True)
+        return
+
+    granularity, start, end, label = parsed
+    buckets = await asyncio.to_thread(transaction_rollups.read, granularity, start, end)
+
+    totals = {field: 0 for field in ROLLUP_FIELDS}
+    for bucket in buckets:
+        for field in ROLLUP_FIELDS:
+            totals[field] += bucket.get(field, 0)
+    unique_users = estimate_unique(merge_sketches(bucket.get("sketch", {}) for bucket in buckets))
+
+    embed = discord.Embed(
+        title="📈 Cashback Report",
+        description=f"Showing activity for {label} (UTC)",
+        color=discord.Color.blue(),
+        timestamp=discord.utils.utcnow(),
+    )
+
+    embed.add_field(name="Redeemed", value=f"**${totals['redeemed_amount']:.2f}**", inline=True)
+    embed.add_field(name="Codes Redeemed", value=f"**{totals['codes_redeemed']}**", inline=True)
+    embed.add_field(name="Unique Users", value=f"**~{unique_users}**", inline=True)
+    embed.add_field(
+        name="Withdrawals Requested",
+        value=f"**{totals['withdrawals_requested']}** (${totals['withdrawal_amount_requested']:.2f})",
+        inline=True
+    )
+    embed.add_field(
+        name="Withdrawals Approved",
+        value=f"**{totals['withdrawals_approved']}** (${totals['withdrawal_amount_approved']:.2f})",
+        inline=True
+    )
+    embed.add_field(name="Withdrawals Rejected", value=f"**{totals['withdrawals_rejected']}**", inline=True)
+
+    embed.set_footer(text=f"{len(buckets)} {granularity} bucket(s) • Cashback System")
+    await ctx.send(embed=embed, ephemeral=True)
+
+@bot.command(name="backfill_rollups")
+@commands.has_role("Staff")
+async def backfill_rollups(ctx):
+    """Rebuild the reporting rollups for every day before today."""
+    await ctx.send("⏳ Rebuilding report rollups from transaction history...", ephemeral=True)
+    cutoff = TransactionRollups.bucket_start("day", datetime.now(UTC))
+    try:
+        with pymongo.timeout(MONGODB_LONG_TIMEOUT):
+            await asyncio.to_thread(transaction_rollups.backfill, cutoff)
+    except PyMongoError as e:
+        print(f"Failed to backfill transaction rollups: {e}")
+        await ctx.send("❌ Failed to rebuild report rollups.", ephemeral=True)
+        return
+    await ctx.send(f"✅ Report rollups rebuilt up to {cutoff.strftime('%Y-%m-%d')}.", ephemeral=True)
+
 @bot.event
 async def on_command_error(ctx, error):
     """Handle command errors."""
@@ -749,4 +2210,5 @@ async def on_ready():
         print(f"Failed to sync commands: {e}")
 
 # Run the bot
-bot.run("Your Discord Token") 
+if __name__ == "__main__":
+    bot.run("Your Discord Token") 
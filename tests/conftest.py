@@ -0,0 +1,33 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+# Keep the intent journal in memory and make main.py importable
+os.environ.setdefault("JOURNAL_PATH", ":memory:")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class BulkWriteCollection:
+    """mongomock collection whose bulk_write accepts current pymongo UpdateOne objects."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.collection.update_one(request._filter, request._doc, upsert=request._upsert)
+
+
+@pytest.fixture
+def mongo_db():
+    return mongomock.MongoClient().db
+
+
+@pytest.fixture
+def rollups_collection(mongo_db):
+    return BulkWriteCollection(mongo_db.transaction_rollups)
@@ -0,0 +1,86 @@
+import asyncio
+
+from pymongo.errors import ExecutionTimeout, OperationFailure
+
+import main
+from main import ActiveCodeCache, ChangeStreamWatcher, XPLeaderboard
+
+
+class FailingDatabase:
+    """Raises one error per watch() call."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def watch(self, pipeline, **kwargs):
+        self.calls += 1
+        raise self.errors.pop(0)
+
+
+def make_watcher(database, mongo_db):
+    watcher = ChangeStreamWatcher(database, mongo_db.change_stream_state, "test", 5, retry_delay=0)
+    watcher.register("codes", lambda change: None)
+    return watcher
+
+
+def test_watcher_retries_timeouts_and_stops_on_fatal_errors(mongo_db):
+    database = FailingDatabase([
+        ExecutionTimeout("operation exceeded time limit", 50),
+        OperationFailure("interrupted", 11601),
+        OperationFailure("The $changeStream stage is only supported on replica sets", 40573),
+    ])
+    watcher = make_watcher(database, mongo_db)
+
+    watcher._watch(None)
+
+    assert database.calls == 3
+    assert watcher.opened_event.is_set()
+
+
+def test_profile_delete_is_applied_without_reload(monkeypatch, mongo_db):
+    mongo_db.user_profiles.insert_many([{"user_id": "1", "xp": 50}, {"user_id": "2", "xp": 300}])
+    leaderboard = XPLeaderboard(mongo_db.user_profiles)
+    monkeypatch.setattr(main, "xp_leaderboard", leaderboard)
+    asyncio.run(leaderboard.reload())
+    deleted = mongo_db.user_profiles.find_one({"user_id": "2"})
+
+    main.handle_profile_change({"operationType": "delete", "documentKey": {"_id": deleted["_id"]}})
+
+    assert leaderboard.standing("2") is None
+    assert leaderboard.standing("1") == (1, 50)
+    assert not leaderboard.reload_pending
+
+
+def test_code_delete_is_applied_without_reload(monkeypatch, mongo_db):
+    codes = ActiveCodeCache(mongo_db.codes)
+    monkeypatch.setattr(main, "active_codes", codes)
+    code = {"_id": "doc-1", "code": "ABC", "amount": 5.0, "redeemed": False}
+
+    main.handle_code_change({"operationType": "insert", "fullDocument": code, "documentKey": {"_id": "doc-1"}})
+    assert codes.get("ABC") == 5.0
+    main.handle_code_change({"operationType": "delete", "documentKey": {"_id": "doc-1"}})
+
+    assert "ABC" not in codes
+    assert not codes.reload_pending
+
+
+def test_overlapping_reload_requests_are_merged(mongo_db):
+    leaderboard = XPLeaderboard(mongo_db.user_profiles)
+    fetch = leaderboard.fetch
+    calls = []
+
+    def counting_fetch():
+        calls.append(1)
+        return fetch()
+
+    leaderboard.fetch = counting_fetch
+
+    async def scenario():
+        for _ in range(5):
+            leaderboard.schedule_reload()
+        await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}))
+
+    asyncio.run(scenario())
+    assert len(calls) == 1
+    assert not leaderboard.reload_pending
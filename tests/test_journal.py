@@ -0,0 +1,207 @@
+import asyncio
+from datetime import datetime, timedelta, UTC
+
+import pytest
+from pymongo.errors import AutoReconnect, DuplicateKeyError
+
+import main
+from main import CircuitBreaker, IntentJournal, JournalReplayer, TransactionRollups
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def collections(monkeypatch, mongo_db, rollups_collection):
+    monkeypatch.setattr(main, "users_collection", mongo_db.users)
+    monkeypatch.setattr(main, "codes_collection", mongo_db.codes)
+    monkeypatch.setattr(main, "transactions_collection", mongo_db.transactions)
+    monkeypatch.setattr(main, "transaction_rollups", TransactionRollups(rollups_collection, None))
+    return mongo_db
+
+
+def make_intent(kind, user_id, payload):
+    journal = IntentJournal(":memory:")
+    journal.append(kind, user_id, payload)
+    return journal.pending()[0]
+
+
+def test_breaker_opens_after_threshold_and_allows_one_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    breaker.record_failure()
+    assert breaker.allow() and not breaker.open
+
+    breaker.record_failure()
+    assert breaker.open and not breaker.allow()
+
+    clock.now += 10
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.open and breaker.allow()
+
+
+def test_failed_trial_keeps_breaker_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.record_failure()
+
+    clock.now += 5
+    assert not breaker.allow()
+
+
+def test_journal_round_trips_intents_in_order():
+    journal = IntentJournal(":memory:")
+    first = journal.append("code_redeem", 1, {"code": "ABC"})
+    second = journal.append("withdrawal", "2", {"amount": 5.0})
+
+    pending = journal.pending()
+
+    assert [intent["intent_id"] for intent in pending] == [first, second]
+    assert pending[0]["user_id"] == "1"
+    assert pending[1]["payload"] == {"amount": 5.0}
+    assert journal.has_pending_code("ABC") and not journal.has_pending_code("XYZ")
+    assert journal.recent_count("1", "code_redeem", timedelta(minutes=1)) == 1
+
+    journal.remove(first)
+    assert [intent["intent_id"] for intent in journal.pending()] == [second]
+
+
+def test_redemption_replay_is_idempotent(collections):
+    collections.codes.insert_one({"code": "ABC", "amount": 7.5, "redeemed": False})
+    collections.users.insert_one({"user_id": "1", "balance": 0.0, "total_earned": 0.0})
+    intent = make_intent("code_redeem", "1", {"code": "ABC"})
+
+    assert main.apply_redemption_intent(intent) == (7.5, True)
+    assert main.apply_redemption_intent(intent) == (7.5, False)
+
+    user = collections.users.find_one({"user_id": "1"})
+    assert user["balance"] == 7.5 and user["total_earned"] == 7.5
+    assert collections.transactions.count_documents({"transaction_id": intent["intent_id"]}) == 1
+    assert collections.codes.find_one({"code": "ABC"})["redeemed"] is True
+
+
+def test_replay_finishes_redemption_claimed_online(collections):
+    # The online path claimed the code and stored the ledger row, then the credit failed
+    collections.codes.insert_one({"code": "ABC", "amount": 7.5, "redeemed": True, "intent_id": "TX1"})
+    collections.users.insert_one({"user_id": "1", "balance": 0.0, "total_earned": 0.0})
+    collections.transactions.insert_one({"transaction_id": "TX1", "user_id": "1", "amount": 7.5})
+    journal = IntentJournal(":memory:")
+    claimed_at = datetime(2025, 3, 10, tzinfo=UTC)
+    journal.append("code_redeem", "1", {"code": "ABC"}, intent_id="TX1", created_at=claimed_at)
+    intent = journal.pending()[0]
+
+    assert intent["intent_id"] == "TX1" and intent["created_at"] == claimed_at
+    assert main.apply_redemption_intent(intent) == (7.5, True)
+    assert main.apply_redemption_intent(intent) == (7.5, False)
+    assert collections.users.find_one({"user_id": "1"})["balance"] == 7.5
+    assert collections.transactions.count_documents({"transaction_id": "TX1"}) == 1
+
+
+def test_replay_recognises_claim_that_timed_out_after_landing(collections):
+    collections.codes.insert_one({"code": "ABC", "amount": 7.5, "redeemed": True, "intent_id": "TX2"})
+    collections.users.insert_one({"user_id": "1", "balance": 0.0, "total_earned": 0.0})
+    journal = IntentJournal(":memory:")
+    journal.append("code_redeem", "1", {"code": "ABC"}, intent_id="TX2")
+
+    assert main.apply_redemption_intent(journal.pending()[0]) == (7.5, True)
+    assert collections.transactions.count_documents({"transaction_id": "TX2"}) == 1
+
+
+def test_redemption_replay_rejects_code_taken_by_someone_else(collections):
+    collections.codes.insert_one({"code": "ABC", "amount": 7.5, "redeemed": True})
+    collections.users.insert_one({"user_id": "1", "balance": 0.0, "total_earned": 0.0})
+    intent = make_intent("code_redeem", "1", {"code": "ABC"})
+
+    assert main.apply_redemption_intent(intent) is None
+    assert collections.users.find_one({"user_id": "1"})["balance"] == 0.0
+    assert collections.transactions.count_documents({}) == 0
+
+
+def test_withdrawal_replay_is_idempotent(collections):
+    collections.users.insert_one({"user_id": "1", "balance": 10.0, "total_withdrawn": 0.0})
+    intent = make_intent("withdrawal", "1", {"amount": 4.0})
+
+    assert main.apply_withdrawal_intent(intent) == 6.0
+    assert main.apply_withdrawal_intent(intent) == 6.0
+
+    user = collections.users.find_one({"user_id": "1"})
+    assert user["balance"] == 6.0 and user["total_withdrawn"] == 4.0
+    transaction = collections.transactions.find_one({"transaction_id": intent["intent_id"]})
+    assert transaction["status"] == "pending"
+    assert collections.transactions.count_documents({}) == 1
+
+
+def test_withdrawal_replay_rejects_insufficient_balance(collections):
+    collections.users.insert_one({"user_id": "1", "balance": 3.0, "total_withdrawn": 0.0})
+    intent = make_intent("withdrawal", "1", {"amount": 4.0})
+
+    assert main.apply_withdrawal_intent(intent) is None
+    assert collections.users.find_one({"user_id": "1"})["balance"] == 3.0
+    assert collections.transactions.count_documents({}) == 0
+
+
+def test_replayer_stops_on_outage_and_skips_other_errors(monkeypatch, clock):
+    journal = IntentJournal(":memory:")
+    poisoned = journal.append("code_redeem", "1", {"code": "BAD"})
+    applied = journal.append("code_redeem", "1", {"code": "GOOD"})
+    blocked = journal.append("withdrawal", "1", {"amount": 2.0})
+
+    async def replay_redemption(intent):
+        if intent["payload"]["code"] == "BAD":
+            raise DuplicateKeyError("duplicate")
+        return True
+
+    async def replay_withdrawal(intent):
+        raise AutoReconnect("primary stepped down")
+
+    monkeypatch.setattr(main, "replay_redemption", replay_redemption)
+    monkeypatch.setattr(main, "replay_withdrawal", replay_withdrawal)
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+
+    asyncio.run(JournalReplayer(journal, breaker, interval=1).replay())
+
+    remaining = [intent["intent_id"] for intent in journal.pending()]
+    assert remaining == [poisoned, blocked]
+    assert applied not in remaining
+    assert breaker.open
+
+
+def test_withdrawal_stays_queued_until_it_is_posted(monkeypatch, collections):
+    collections.users.insert_one({"user_id": "1", "balance": 10.0, "total_withdrawn": 0.0})
+    journal = IntentJournal(":memory:")
+    intent_id = journal.append("withdrawal", "1", {
+        "amount": 4.0, "guild_id": 1, "category_name": "Withdrawals", "channel_name": "requests"
+    })
+    notifications = []
+
+    async def send_notification(user, message, interaction=None):
+        notifications.append(message)
+
+    monkeypatch.setattr(main.bot, "get_guild", lambda guild_id: None)
+    monkeypatch.setattr(main, "send_notification", send_notification)
+    replayer = JournalReplayer(journal, CircuitBreaker(failure_threshold=1, reset_timeout=10), interval=1)
+
+    asyncio.run(replayer.replay())
+    asyncio.run(replayer.replay())
+
+    assert [intent["intent_id"] for intent in journal.pending()] == [intent_id]
+    assert collections.users.find_one({"user_id": "1"})["balance"] == 6.0
+    assert notifications == []
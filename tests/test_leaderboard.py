@@ -0,0 +1,65 @@
+from main import XPLeaderboard, level_for_xp
+
+
+def make_leaderboard(xp_by_user):
+    leaderboard = XPLeaderboard(collection=None)
+    leaderboard.replace(dict(xp_by_user))
+    return leaderboard
+
+
+def test_top_is_ordered_by_xp_then_user_id():
+    leaderboard = make_leaderboard({"1": 50, "2": 300, "3": 50, "4": 120})
+
+    assert leaderboard.top(10) == [("2", 300), ("4", 120), ("1", 50), ("3", 50)]
+    assert leaderboard.top(2, offset=1) == [("4", 120), ("1", 50)]
+
+
+def test_position_is_one_based():
+    leaderboard = make_leaderboard({"1": 50, "2": 300, "3": 50})
+
+    assert leaderboard.position("2") == 1
+    assert leaderboard.position(1) == 2
+    assert leaderboard.position("3") == 3
+    assert leaderboard.position("missing") is None
+
+
+def test_standing_returns_position_and_xp():
+    leaderboard = make_leaderboard({"1": 50, "2": 300})
+
+    assert leaderboard.standing(1) == (2, 50)
+    assert leaderboard.standing("2") == (1, 300)
+    assert leaderboard.standing("missing") is None
+
+
+def test_level_for_xp():
+    assert [level_for_xp(xp) for xp in (0, 999, 1000, 2500)] == [1, 1, 2, 3]
+
+
+def test_update_moves_user_to_new_position():
+    leaderboard = make_leaderboard({"1": 100, "2": 200, "3": 300})
+
+    leaderboard.update("1", 400)
+
+    assert leaderboard.position("1") == 1
+    assert leaderboard.position("3") == 2
+    assert len(leaderboard) == 3
+    assert leaderboard.xp_by_user["1"] == 400
+
+
+def test_update_adds_new_users():
+    leaderboard = make_leaderboard({"1": 100})
+
+    leaderboard.update(2, 0)
+
+    assert leaderboard.top(10) == [("1", 100), ("2", 0)]
+
+
+def test_remove_drops_user_and_shifts_others_up():
+    leaderboard = make_leaderboard({"1": 100, "2": 200, "3": 300})
+
+    leaderboard.remove("3")
+    leaderboard.remove("missing")
+
+    assert leaderboard.position("3") is None
+    assert leaderboard.position("2") == 1
+    assert leaderboard.top(10) == [("2", 200), ("1", 100)]
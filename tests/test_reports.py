@@ -0,0 +1,82 @@
+from datetime import datetime, UTC
+
+from main import (
+    TransactionRollups, estimate_unique, merge_sketches, parse_report_range, rollup_event,
+    withdrawal_outcome_event
+)
+
+NOW = datetime(2025, 3, 10, 14, 35, tzinfo=UTC)
+
+
+def test_hour_range_ends_after_current_hour():
+    granularity, start, end, label = parse_report_range("24h", NOW)
+
+    assert granularity == "hour"
+    assert end == datetime(2025, 3, 10, 15, tzinfo=UTC)
+    assert start == datetime(2025, 3, 9, 15, tzinfo=UTC)
+    assert label == "Last 24 hour(s)"
+
+
+def test_day_range_includes_today():
+    granularity, start, end, _ = parse_report_range("7D", NOW)
+
+    assert granularity == "day"
+    assert start == datetime(2025, 3, 4, tzinfo=UTC)
+    assert end == datetime(2025, 3, 11, tzinfo=UTC)
+
+
+def test_single_date_and_date_range_are_inclusive():
+    assert parse_report_range("2025-01-31", NOW)[1:3] == (
+        datetime(2025, 1, 31, tzinfo=UTC), datetime(2025, 2, 1, tzinfo=UTC)
+    )
+    assert parse_report_range("2025-01-01:2025-01-31", NOW)[1:] == (
+        datetime(2025, 1, 1, tzinfo=UTC), datetime(2025, 2, 1, tzinfo=UTC), "2025-01-01 to 2025-01-31"
+    )
+
+
+def test_invalid_ranges_are_rejected():
+    for value in ["", "0h", "169h", "0d", "367d", "-1d", "abc", "2025-13-01", "2025-02-01:2025-01-01",
+                  "2024-01-01:2025-12-31"]:
+        assert parse_report_range(value, NOW) is None, value
+
+
+def test_sketch_estimates_unique_users(rollups_collection):
+    rollups = TransactionRollups(rollups_collection, None)
+    events = [rollup_event({
+        "type": "code_redeem", "amount": 1.0, "timestamp": NOW, "user_id": str(i % 500)
+    }) for i in range(1500)]
+
+    rollups.record(events)
+
+    bucket = rollups.collection.find_one({"_id": "day:2025-03-10"})
+    assert bucket["codes_redeemed"] == 1500
+    assert len(bucket["sketch"]) <= 1024
+    assert abs(estimate_unique(bucket["sketch"]) - 500) < 500 * 0.1
+
+
+def test_merged_sketches_count_users_once(rollups_collection):
+    rollups = TransactionRollups(rollups_collection, None)
+    for day in (9, 10):
+        rollups.record([rollup_event({
+            "type": "withdrawal", "amount": 5.0, "timestamp": NOW.replace(day=day), "user_id": str(i)
+        }) for i in range(50)])
+
+    buckets = rollups.read("day", datetime(2025, 3, 9, tzinfo=UTC), datetime(2025, 3, 11, tzinfo=UTC))
+
+    assert sum(bucket["withdrawals_requested"] for bucket in buckets) == 100
+    merged = merge_sketches(bucket["sketch"] for bucket in buckets)
+    assert merged == buckets[0]["sketch"]
+    assert abs(estimate_unique(merged) - 50) <= 2
+    assert estimate_unique({}) == 0
+
+
+def test_withdrawal_outcomes_land_in_request_bucket(rollups_collection):
+    rollups = TransactionRollups(rollups_collection, None)
+    request = {"type": "withdrawal", "amount": 8.0, "timestamp": NOW, "user_id": "1"}
+
+    rollups.record([rollup_event(request), withdrawal_outcome_event(request, "completed")])
+
+    bucket = rollups.collection.find_one({"_id": "hour:2025-03-10T14"})
+    assert bucket["withdrawals_requested"] == 1
+    assert bucket["withdrawals_approved"] == 1
+    assert bucket["withdrawal_amount_approved"] == 8.0
@@ -0,0 +1,122 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from main import TransactionLogWriter
+
+
+class FakeCollection:
+    """Records insert calls and optionally fails them."""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.inserted = []
+        self.error = error
+
+    def insert_many(self, records, ordered=True):
+        self.batches.append(list(records))
+        if self.error:
+            raise self.error
+        self.inserted.extend(records)
+
+    def insert_one(self, record):
+        self.inserted.append(record)
+
+
+def run_writer(collection, records, max_batch_size=3, flush_interval=0.05, after_flush=None):
+    """Submit records concurrently through a running writer and return the outcomes."""
+    async def scenario():
+        writer = TransactionLogWriter(collection, max_batch_size, flush_interval, after_flush)
+        writer.start()
+        results = await asyncio.gather(
+            *(writer.submit(record) for record in records), return_exceptions=True
+        )
+        await writer.stop()
+        return results
+
+    return asyncio.run(scenario())
+
+
+def test_batches_are_capped_at_max_batch_size():
+    collection = FakeCollection()
+    records = [{"transaction_id": str(i)} for i in range(7)]
+
+    results = run_writer(collection, records)
+
+    assert results == [None] * 7
+    assert [len(batch) for batch in collection.batches] == [3, 3, 1]
+    assert collection.inserted == records
+
+
+def test_stop_drains_queued_records():
+    collection = FakeCollection()
+    records = [{"transaction_id": str(i)} for i in range(5)]
+
+    async def scenario():
+        writer = TransactionLogWriter(collection, 100, 60)
+        writer.start()
+        pending = [asyncio.create_task(writer.submit(record)) for record in records]
+        await asyncio.sleep(0)
+        # The flush interval is far away, so only stop() can write these
+        await writer.stop()
+        return await asyncio.gather(*pending)
+
+    assert asyncio.run(scenario()) == [None] * 5
+    assert collection.inserted == records
+
+
+def test_submit_during_stop_writes_directly():
+    collection = FakeCollection()
+
+    async def scenario():
+        writer = TransactionLogWriter(collection, 100, 60)
+        writer.start()
+        queued = asyncio.create_task(writer.submit({"transaction_id": "A"}))
+        await asyncio.sleep(0)
+        stopping = asyncio.create_task(writer.stop())
+        await asyncio.sleep(0)
+        # Arrives after the stop marker; it must not wait on a flush loop that is gone
+        await asyncio.wait_for(writer.submit({"transaction_id": "B"}), timeout=1)
+        await stopping
+        await queued
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert sorted(record["transaction_id"] for record in collection.inserted) == ["A", "B"]
+    assert not writer.running and not writer.stopping
+
+
+def test_partial_bulk_write_error_only_fails_rejected_records():
+    error = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "duplicate"}]})
+    collection = FakeCollection(error=error)
+    records = [{"transaction_id": str(i)} for i in range(3)]
+    flushed = []
+
+    results = run_writer(collection, records, after_flush=flushed.extend)
+
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], BulkWriteError)
+    assert flushed == [records[0], records[2]]
+
+
+def test_failed_flush_fails_every_record():
+    collection = FakeCollection(error=AutoReconnect("primary stepped down"))
+    records = [{"transaction_id": str(i)} for i in range(2)]
+    flushed = []
+
+    results = run_writer(collection, records, after_flush=flushed.extend)
+
+    assert all(isinstance(result, AutoReconnect) for result in results)
+    assert flushed == []
+
+
+def test_submit_writes_directly_when_not_running():
+    collection = FakeCollection()
+    flushed = []
+    writer = TransactionLogWriter(collection, 100, 0.05, after_flush=flushed.extend)
+
+    asyncio.run(writer.submit({"transaction_id": "A"}))
+
+    assert collection.inserted == [{"transaction_id": "A"}]
+    assert collection.batches == []
+    assert flushed == [{"transaction_id": "A"}]